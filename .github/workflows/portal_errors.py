@@ -0,0 +1,40 @@
+"""
+Failure reporting shared by the publish scripts, which run from this directory.
+"""
+
+import logging
+import re
+
+# arcgis-python-api raises a plain Exception for portal JSON errors (AGOL answers
+# HTTP 200), with the portal's code appended as "(Error Code: 498)"
+_PORTAL_ERROR_RE = re.compile(r'\(Error Code: (\d+)\)\s*$')
+
+
+def portal_error_code(exc: Exception) -> int | None:
+    """Return the portal error code carried by an SDK exception, or None."""
+    match = _PORTAL_ERROR_RE.search(str(exc))
+    return int(match.group(1)) if match else None
+
+
+def is_expected_failure(exc: Exception) -> bool:
+    """True for HTTP and portal errors (invalid token, no permission, missing item)."""
+    from requests import HTTPError
+    return isinstance(exc, HTTPError) or portal_error_code(exc) is not None
+
+
+def report_failure(exc: Exception) -> int:
+    """Report a publish failure and return the exit code.
+
+    Expected failures get one line and exit code 2; the response body says
+    more than a traceback would. Anything else is logged with its traceback
+    and gets exit code 1.
+    """
+    if not is_expected_failure(exc):
+        logging.exception("ERROR: %s", exc)
+        return 1
+    response = getattr(exc, "response", None)
+    if response is not None:
+        print(f"ERROR: HTTP {response.status_code}: {response.text[:500]}")
+    else:
+        print(f"ERROR: {exc}")
+    return 2
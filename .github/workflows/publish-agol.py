@@ -7,39 +7,213 @@ description version line, tags) on the existing AGOL item.
 """
 
 import os
+import re
 import sys
+import time
 import argparse
+import functools
+import hashlib
+import logging
 from pathlib import Path
 
+from portal_errors import is_expected_failure, report_failure
+
 if sys.platform == "win32":
     if hasattr(sys.stdout, 'reconfigure'):
         sys.stdout.reconfigure(encoding='utf-8', errors='replace')
     if hasattr(sys.stderr, 'reconfigure'):
         sys.stderr.reconfigure(encoding='utf-8', errors='replace')
-    os.environ['PYTHONIOENCODING'] = 'utf-8'
 
-try:
-    from arcgis.gis import GIS
-    from arcgis import __version__ as arcgis_version
-except ImportError:
-    print("ERROR: arcgis-python-api is not installed. Install with: pip install arcgis")
-    sys.exit(1)
+logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+
+# ArcGIS Online's per-item upload limit; larger files are rejected only after the full upload
+MAX_ADDIN_BYTES = 2 * 1024 * 1024 * 1024
+
+# Item.update switches to its own addPart/commit upload above this size; stream anything smaller
+STREAM_UPLOAD_MAX_BYTES = int(2.5e7)
+STREAM_UPLOAD_ATTEMPTS = 3
+STREAM_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# typeKeyword recording the SHA-256 of the last uploaded add-in, so identical rebuilds skip the upload
+ADDIN_DIGEST_PREFIX = "sha256:"
+
+# First 'Latest Version:' line, matched the same way update_version_line finds it
+_VERSION_RE = re.compile(r'^[ \t]*Latest Version:.*', re.MULTILINE)
+
+def _lazy_import_arcgis():
+    """Import arcgis only once arguments are valid; it pulls in pandas, numpy and friends.
+
+    Returns (GIS, version), or None after reporting that arcgis is missing.
+    """
+    try:
+        from arcgis.gis import GIS
+        from arcgis import __version__ as arcgis_version
+    except ImportError:
+        print("ERROR: arcgis-python-api is not installed. Install with: pip install arcgis")
+        return None
+    return GIS, arcgis_version
+
+
+@functools.lru_cache(maxsize=4)
+def _get_gis(portal_url: str, client_id: str | None = None, client_secret: str | None = None,
+             username: str | None = None, password: str | None = None):
+    """Connect once per portal and credential set; later publish() calls share the session."""
+    GIS, _ = _lazy_import_arcgis()
+    if client_id:
+        return GIS(url=portal_url, client_id=client_id, client_secret=client_secret)
+    return GIS(url=portal_url, username=username, password=password)
+
+
+def addin_digest(addin_path: Path) -> str:
+    """SHA-256 of the add-in file, hex encoded."""
+    with open(addin_path, "rb") as addin_file:
+        return hashlib.file_digest(addin_file, "sha256").hexdigest()
+
+
+def current_version_line(description: str) -> str | None:
+    """Return the description's 'Latest Version:' line, stripped, or None."""
+    match = _VERSION_RE.search(description or "")
+    return match.group(0).strip() if match else None
 
 
 def update_version_line(current_description: str, new_version_line: str) -> str:
     """Replace the 'Latest Version:' line in the description, or prepend it."""
-    lines = (current_description or "").split('\n')
-    updated = []
-    replaced = False
-    for line in lines:
-        if line.strip().startswith('Latest Version:'):
-            updated.append(new_version_line)
-            replaced = True
+    if not current_description:
+        return new_version_line
+    # split('\n') rather than splitlines() so CRLF endings and a trailing
+    # newline are kept; the replaced line keeps its own '\r' too
+    lines = current_description.split('\n')
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith('Latest Version:'):
+            lines[i] = new_version_line + ('\r' if line.endswith('\r') else '')
+            return '\n'.join(lines)
+    return new_version_line + "\n\n" + current_description
+
+
+def changed_metadata(item, metadata: dict) -> dict:
+    """Drop fields that already match the item; tags compare as sets."""
+    changed = {}
+    for key, value in metadata.items():
+        current = getattr(item, key, None)
+        if key == "tags":
+            if set(current or []) != set(value):
+                changed[key] = value
+        elif (current or "") != value:
+            changed[key] = value
+    return changed
+
+
+def stream_update(gis, item, addin_path: Path, metadata: dict) -> bool:
+    """POST the add-in and metadata to the item's update endpoint, streaming the file from disk.
+
+    Item.update hands the file to requests, which builds the whole multipart
+    body in memory before sending; MultipartEncoder reads it as the socket drains.
+    """
+    url = f"{gis._portal.resturl}content/users/{item.owner}"
+    if item.ownerFolder:
+        url += f"/{item.ownerFolder}"
+    url += f"/items/{item.itemid}/update"
+
+    import requests
+    from requests_toolbelt import MultipartEncoder
+    from urllib3.util import Retry
+
+    fields = {"f": "json"}
+    for key, value in metadata.items():
+        fields[key] = ",".join(value) if key in ("tags", "typeKeywords") else value
+
+    # A MultipartEncoder can be read only once, so the session adapter must not
+    # replay it: a retried POST would announce the full Content-Length over a
+    # drained body and hang until the read timeout. Retry here instead, with a
+    # fresh encoder over a reopened file each time.
+    session = gis._con._session
+    adapter = getattr(session, "_session", session).get_adapter(url)
+    adapter_retries = adapter.max_retries
+    adapter.max_retries = Retry(0, read=False)
+    try:
+        for attempt in range(STREAM_UPLOAD_ATTEMPTS):
+            if attempt:
+                time.sleep(2 ** attempt)
+            last_attempt = attempt == STREAM_UPLOAD_ATTEMPTS - 1
+            with open(addin_path, "rb") as addin_file:
+                encoder = MultipartEncoder(
+                    fields={**fields, "file": (addin_path.name, addin_file, "application/octet-stream")})
+                try:
+                    resp = session.post(url, data=encoder, headers={"Content-Type": encoder.content_type},
+                                        timeout=(10, 600))
+                except requests.ConnectionError:
+                    if last_attempt:
+                        raise
+                    continue
+            if resp.status_code not in STREAM_RETRY_STATUSES or last_attempt:
+                break
+    finally:
+        adapter.max_retries = adapter_retries
+    resp.raise_for_status()
+    result = resp.json()
+    if "error" in result:
+        # Same shape as the SDK's own portal errors, so publish() treats it as expected
+        error = result["error"]
+        raise RuntimeError(f"{error.get('message', error)}\n(Error Code: {error.get('code')})")
+    return bool(result.get("success"))
+
+
+def upload_combined(gis, item, addin_path: Path, size: int, metadata: dict, digest_props: dict) -> bool:
+    """Send the add-in and metadata in one update request, streaming when the SDK would buffer.
+
+    digest_props must only land once the file has. Up to the by-part threshold
+    it travels in the same request as the file; above it, Item.update writes
+    properties before uploading the parts, so it follows in one extra request
+    after a successful upload.
+    """
+    import requests
+
+    if size <= STREAM_UPLOAD_MAX_BYTES:
+        try:
+            return stream_update(gis, item, addin_path, {**metadata, **digest_props})
+        except (ImportError, requests.ConnectionError, requests.Timeout) as e:
+            # Only transport and encoder failures; a portal error would fail the SDK upload too
+            print(f"WARNING: streamed upload failed ({e}); retrying through arcgis-python-api")
+        return item.update(item_properties={**metadata, **digest_props}, data=str(addin_path))
+    uploaded = item.update(item_properties=metadata or None, data=str(addin_path))
+    if uploaded and not item.update(item_properties=digest_props):
+        print("WARNING: could not record the add-in digest; the next run will upload again")
+    return uploaded
+
+
+def upload_separately(item, addin_path: Path, metadata: dict, digest_props: dict) -> None:
+    """Upload the file, then update metadata, as two requests.
+
+    The digest rides on the metadata request only when there is one and the
+    upload succeeded, so an unchanged item still gets a single request; the
+    next run then re-uploads instead of skipping.
+    """
+    uploaded = item.update(data=str(addin_path))
+    if not uploaded:
+        print("WARNING: upload returned False - file may still have been uploaded")
+    else:
+        print("[OK]   File uploaded")
+    if metadata:
+        if not item.update(item_properties={**metadata, **digest_props} if uploaded else metadata):
+            print("WARNING: metadata update returned False")
         else:
-            updated.append(line)
-    if not replaced:
-        return new_version_line + "\n\n" + (current_description or "")
-    return '\n'.join(updated)
+            print("[OK]   Metadata updated")
+
+
+def fetch_verified_item(gis, item_id: str, version_line: str | None, attempts: int = 2):
+    """Fetch the item, reading it once more after a short pause if AGOL still serves the old description.
+
+    Returns (item, verified). verified is always True when there is no
+    version line to check.
+    """
+    item = None
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(0.5 * attempt)
+        item = gis.content.get(item_id)
+        if not version_line or current_version_line(item.description) == version_line:
+            return item, True
+    return item, False
 
 
 def main():
@@ -49,31 +223,55 @@ def main():
     parser.add_argument("--portal-url", default="https://www.arcgis.com", help="Portal URL")
     parser.add_argument("--auth-method", choices=["token", "username"], default="token")
     parser.add_argument("--client-id", help="OAuth2 client ID (for token auth)")
-    parser.add_argument("--client-secret", help="OAuth2 client secret (for token auth)")
+    parser.add_argument("--client-secret", default=os.environ.get("AGOL_CLIENT_SECRET"),
+                        help="OAuth2 client secret (for token auth; defaults to $AGOL_CLIENT_SECRET)")
     parser.add_argument("--username", help="Portal username (for username auth)")
-    parser.add_argument("--password", help="Portal password (for username auth)")
+    parser.add_argument("--password", default=os.environ.get("AGOL_PASSWORD"),
+                        help="Portal password (for username auth; defaults to $AGOL_PASSWORD)")
     parser.add_argument("--title", help="Item title (optional)")
     parser.add_argument("--description", help="Description or 'Latest Version: ...' line (optional)")
     parser.add_argument("--tags", help="Comma-separated tags (optional)")
+    parser.add_argument("--separate-metadata-update", action="store_true",
+                        help="Upload the file and update metadata as two requests instead of one")
 
     args = parser.parse_args()
+    sys.exit(publish(args))
+
+
+def publish(args) -> int:
+    """Upload the add-in and update item metadata; returns a process exit code.
 
+    Kept separate from argument parsing so a long-running caller can publish
+    repeatedly in one process and reuse the authenticated GIS from _get_gis.
+    """
     addin_path = Path(args.addin_file)
-    if not addin_path.exists():
+    try:
+        addin_stat = addin_path.stat()
+    except FileNotFoundError:
         print(f"ERROR: Add-in file not found: {addin_path}")
-        sys.exit(1)
+        return 1
+    size_mb = addin_stat.st_size / (1 << 20)
+    if addin_stat.st_size > MAX_ADDIN_BYTES:
+        print(f"ERROR: Add-in file is {size_mb:.2f} MB, "
+              f"over the {MAX_ADDIN_BYTES >> 20} MB ArcGIS Online limit: {addin_path}")
+        return 1
 
     if args.auth_method == "token":
         if not args.client_id or not args.client_secret:
             print("ERROR: --client-id and --client-secret required for token auth")
-            sys.exit(1)
+            return 1
     else:
         if not args.username or not args.password:
             print("ERROR: --username and --password required for username auth")
-            sys.exit(1)
+            return 1
+
+    arcgis_import = _lazy_import_arcgis()
+    if arcgis_import is None:
+        return 1
+    _, arcgis_version = arcgis_import
 
     print(f"Portal: {args.portal_url}  |  Item: {args.item_id}  |  Auth: {args.auth_method}")
-    print(f"Add-in: {addin_path} ({addin_path.stat().st_size / 1024 / 1024:.2f} MB)")
+    print(f"Add-in: {addin_path} ({size_mb:.2f} MB)")
     print(f"arcgis-python-api {arcgis_version}")
     print()
 
@@ -81,59 +279,105 @@ def main():
         # Authenticate
         print("[AUTH] Connecting...")
         if args.auth_method == "token":
-            gis = GIS(url=args.portal_url, client_id=args.client_id, client_secret=args.client_secret)
+            gis = _get_gis(args.portal_url, client_id=args.client_id, client_secret=args.client_secret)
         else:
-            gis = GIS(url=args.portal_url, username=args.username, password=args.password)
+            gis = _get_gis(args.portal_url, username=args.username, password=args.password)
 
-        user = gis.users.me
-        print(f"[OK]   Logged in as: {user.username if user else 'application (OAuth2)'}")
+        # The portals/self response GIS() already fetched names the user
+        username = (gis.properties.get("user") or {}).get("username")
+        print(f"[OK]   Logged in as: {username or 'application (OAuth2)'}")
 
         # Get item
         item = gis.content.get(args.item_id)
         if not item:
             print(f"ERROR: Item {args.item_id} not found or inaccessible")
-            sys.exit(1)
+            return 1
         print(f"[OK]   Found item: {item.title}")
 
         # Build metadata updates
         metadata = {}
+        version_line = None
         if args.title:
             metadata["title"] = args.title
         if args.description:
             if args.description.startswith("Latest Version:"):
-                metadata["description"] = update_version_line(item.description, args.description.strip())
+                expected_line = args.description.strip()
+                # --description may carry continuation lines; only the first is the version line
+                version_line = expected_line.split('\n', 1)[0].strip()
+                current_desc = item.description or ""
+                # Continuation lines go in with a new version line only; after that just
+                # the version line is swapped, so republishing the same version is a no-op
+                new_line = version_line if current_version_line(current_desc) else expected_line
+                metadata["description"] = update_version_line(current_desc, new_line)
             else:
                 metadata["description"] = args.description
         if args.tags:
             metadata["tags"] = [t.strip() for t in args.tags.split(",")]
 
-        # Upload file
-        print(f"[UPLOAD] Uploading {addin_path.name}...")
-        if not item.update(data=str(addin_path)):
-            print("WARNING: upload returned False – file may still have been uploaded")
-        else:
-            print("[OK]   File uploaded")
+        requested = metadata
+        metadata = changed_metadata(item, requested)
 
-        # Update metadata
         if metadata:
             print(f"[META] Updating: {', '.join(metadata.keys())}...")
-            if not item.update(item_properties=metadata):
-                print("WARNING: metadata update returned False")
+        elif requested:
+            print("[SKIP] Metadata already up to date")
+
+        # Skip the upload when the item already holds these exact bytes
+        digest_keyword = ADDIN_DIGEST_PREFIX + addin_digest(addin_path)
+        type_keywords = list(item.typeKeywords or [])
+        if digest_keyword in type_keywords:
+            print(f"[SKIP] {addin_path.name} unchanged since last upload, not re-uploading")
+            if metadata:
+                if not item.update(item_properties=metadata):
+                    print("WARNING: metadata update returned False")
+                else:
+                    print("[OK]   Metadata updated")
+        else:
+            meta_note = " and metadata updated" if metadata else ""
+            digest_props = {"typeKeywords": [k for k in type_keywords if not k.startswith(ADDIN_DIGEST_PREFIX)]
+                            + [digest_keyword]}
+
+            # Upload file and metadata in a single update request; add-ins over
+            # STREAM_UPLOAD_MAX_BYTES cost one more to record the digest
+            print(f"[UPLOAD] Uploading {addin_path.name}...")
+            if args.separate_metadata_update:
+                upload_separately(item, addin_path, metadata, digest_props)
             else:
-                print("[OK]   Metadata updated")
+                try:
+                    if not upload_combined(gis, item, addin_path, addin_stat.st_size, metadata, digest_props):
+                        print("WARNING: update returned False - file may still have been uploaded")
+                    else:
+                        print("[OK]   File uploaded" + meta_note)
+                except Exception as e:
+                    # Some SDK versions reject data and item_properties together. With no
+                    # metadata, or on a portal/HTTP error, two requests would only repeat it
+                    if not metadata or is_expected_failure(e):
+                        raise
+                    print(f"WARNING: combined update failed ({e}); retrying as separate requests")
+                    upload_separately(item, addin_path, metadata, digest_props)
 
-        # Single verification pass
-        verified = gis.content.get(args.item_id)
+        # Verification pass, only when a version line was actually written; the
+        # fetched item is reused for the summary. A mismatch right after a
+        # successful write is usually read-after-write staleness, so it is
+        # re-read once but never re-sent.
+        updated_item = None
+        if version_line and "description" in metadata:
+            updated_item, verified = fetch_verified_item(gis, args.item_id, version_line)
+            if verified:
+                print("[OK]   Version line verified")
+            else:
+                verif_desc = updated_item.description or ""
+                print(f"WARNING: version line not found in updated description: {version_line}")
+                print(f"         Description ({len(verif_desc)} chars): {verif_desc[:200]!r}")
         print()
         print(f"[DONE] Published successfully")
         print(f"       URL: {args.portal_url}/home/item.html?id={args.item_id}")
-        print(f"       Modified: {verified.modified}")
+        if updated_item is not None:
+            print(f"       Modified: {updated_item.modified}")
+        return 0
 
     except Exception as e:
-        print(f"ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        sys.exit(1)
+        return report_failure(e)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ This script is intended for ArcGIS Pro Python environments where arcpy is availa
 """
 
 import argparse
+import logging
 import os
 import sys
 from pathlib import Path
@@ -16,6 +17,8 @@ except ImportError:
     print("ERROR: arcpy is required. Run this script inside an ArcGIS Pro Python environment.")
     sys.exit(1)
 
+logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Publish locator to ArcGIS Server geocode service")
@@ -68,9 +71,7 @@ def main():
         )
         print(f"[DONE] Published geocode service: {args.service_name}")
     except Exception as ex:
-        print(f"ERROR: {ex}")
-        import traceback
-        traceback.print_exc()
+        logging.exception("ERROR: %s", ex)
         sys.exit(1)
 
 
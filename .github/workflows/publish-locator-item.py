@@ -4,16 +4,18 @@ Publish or update a locator package (.gcpk) item in ArcGIS Online/Portal.
 """
 
 import argparse
+import logging
 import os
 import sys
 from pathlib import Path
 
+from portal_errors import report_failure
+
 if sys.platform == "win32":
     if hasattr(sys.stdout, "reconfigure"):
         sys.stdout.reconfigure(encoding="utf-8", errors="replace")
     if hasattr(sys.stderr, "reconfigure"):
         sys.stderr.reconfigure(encoding="utf-8", errors="replace")
-    os.environ["PYTHONIOENCODING"] = "utf-8"
 
 try:
     from arcgis.gis import GIS
@@ -21,6 +23,8 @@ except ImportError:
     print("ERROR: arcgis-python-api is not installed. Install with: pip install arcgis")
     sys.exit(1)
 
+logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+
 
 def connect(args):
     if args.auth_method == "token":
@@ -38,9 +42,9 @@ def main():
     parser.add_argument("--portal-url", default="https://www.arcgis.com")
     parser.add_argument("--auth-method", choices=["token", "username"], default="token")
     parser.add_argument("--client-id")
-    parser.add_argument("--client-secret")
+    parser.add_argument("--client-secret", default=os.environ.get("AGOL_CLIENT_SECRET"))
     parser.add_argument("--username")
-    parser.add_argument("--password")
+    parser.add_argument("--password", default=os.environ.get("AGOL_PASSWORD"))
     parser.add_argument("--item-id", help="Existing item id to update (optional)")
     parser.add_argument("--title", default="Overture Hybrid Locator")
     parser.add_argument("--tags", default="ArcGIS,Locator,Geocoding,Overture")
@@ -58,8 +62,9 @@ def main():
 
     try:
         gis = connect(args)
-        user = gis.users.me
-        print(f"[OK] Authenticated as: {user.username if user else 'application'}")
+        # Saves a users.me round trip
+        username = (gis.properties.get("user") or {}).get("username")
+        print(f"[OK] Authenticated as: {username or 'application'}")
 
         tags = [t.strip() for t in (args.tags or "").split(",") if t.strip()]
         if args.item_id:
@@ -68,10 +73,12 @@ def main():
                 print(f"ERROR: Could not find item {args.item_id}")
                 sys.exit(1)
             print(f"[INFO] Updating locator item: {item.title}")
-            ok = item.update(
-                item_properties={"title": args.title, "tags": tags},
-                data=str(locator_path),
-            )
+            item_props = {}
+            if item.title != args.title:
+                item_props["title"] = args.title
+            if set(item.tags or []) != set(tags):
+                item_props["tags"] = tags
+            ok = item.update(item_properties=item_props or None, data=str(locator_path))
             if not ok:
                 print("ERROR: Locator item update returned False")
                 sys.exit(1)
@@ -91,10 +98,7 @@ def main():
             sys.exit(1)
         print(f"[DONE] Created locator item: {args.portal_url}/home/item.html?id={item.id}")
     except Exception as ex:
-        print(f"ERROR: {ex}")
-        import traceback
-        traceback.print_exc()
-        sys.exit(1)
+        sys.exit(report_failure(ex))
 
 
 if __name__ == "__main__":